@@ -1,11 +1,87 @@
 """
 control code
 """
+import asyncio
+import http.client
+import json
+import mmap
 import os
+import re
 import sqlite3
-import subprocess
 import sys
+import time
 import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+# Paths to the grader inputs and outputs, resolved once at import
+HOME = os.path.expanduser('~')
+LOGS_DIR = os.path.join(HOME, 'logs')
+STUDENT_CODE_DIR = os.path.join(LOGS_DIR, 'studentcode')
+AUTOGRADER_OUTPUT_FILE = os.path.join(LOGS_DIR, 'autograder_output.txt')
+README_FILE = os.path.join(LOGS_DIR, 'README.md')
+DB_PATH = os.path.join(HOME, 'agllmdatabase.db')
+
+# Binary file types left out of the prompt and the submissions table
+SKIPPED_EXTENSIONS = {'.pyc', '.class', '.o', '.so', '.exe', '.png', '.jpg', '.jpeg', '.gif', '.zip', '.pdf'}
+
+# Longest student file sent to the model in full; longer files keep their head and tail
+MAX_FILE_CHARS = 32000
+
+# Two or more consecutive blank lines, collapsed to one in the prompt
+_BLANK_LINES = re.compile(r'\n(?:[ \t]*\n){2,}')
+
+# Local Ollama server hosting the feedback model
+OLLAMA_HOST = "127.0.0.1"
+OLLAMA_PORT = 11434
+OLLAMA_MODEL = "ux1"
+OLLAMA_TIMEOUT = 600
+
+# Number of threads used to read the student code files
+READ_WORKERS = 8
+
+# Files at least this large are memory-mapped instead of read into a buffer
+MMAP_THRESHOLD = 256 * 1024
+
+# Number of students graded concurrently in batch mode, unless AG_BATCH_CONCURRENCY is set
+DEFAULT_BATCH_CONCURRENCY = 4
+
+# Statements run for every graded student; keeping the SQL text constant lets sqlite3
+# reuse the prepared statements from its per-connection cache.
+# Submission rows are normally inserted by one statement that expands a JSON array of file
+# contents. SQLite's JSON functions end a string at an embedded NUL, so submissions with a NUL
+# anywhere in their code (e.g. UTF-16 sources) are bound row by row instead.
+SQL_INSERT_SUBMISSIONS = '''
+        INSERT INTO submissions (student_repo, assignment_id, code, submitted_at)
+        SELECT ?, ?, je.value, ? FROM json_each(?) AS je
+        RETURNING rowid
+'''
+SQL_INSERT_SUBMISSION = '''
+        INSERT INTO submissions (student_repo, assignment_id, code, submitted_at)
+        VALUES (?, ?, ?, ?)
+        RETURNING rowid
+'''
+SQL_INSERT_AUTOGRADER_OUTPUT = '''
+        INSERT INTO autograder_outputs (submission_id, output, generated_at)
+        VALUES (?, ?, ?)
+'''
+SQL_INSERT_FEEDBACK = '''
+        INSERT INTO feedback (submission_id, feedback_text, generated_at)
+        VALUES (?, ?, ?)
+'''
+
+# Seconds a write waits for a locked database, and how often a write that still found it
+# locked is retried (with exponential backoff starting at DB_RETRY_DELAY seconds)
+DB_BUSY_TIMEOUT = 5.0
+DB_WRITE_ATTEMPTS = 3
+DB_RETRY_DELAY = 0.5
+
+# Shared database connection, see get_db_connection()
+_db_connection = None
+
+# Persistent keep-alive connections to the Ollama server, one per thread, see _get_ollama_connection()
+_ollama_local = threading.local()
 
 def extract_student_id():
         """
@@ -24,6 +100,35 @@ def extract_student_id():
                 sys.exit(1)
 
 
+def _decode_text(data):
+        """
+        Decode a bytes-like object as UTF-8, falling back to ISO-8859-1.
+        """
+        try:
+                return str(data, 'utf-8')
+        except UnicodeDecodeError:
+                # Decode outside the handler so the exception, which holds a copy of the data, is freed first
+                pass
+        # ISO-8859-1 maps every byte, so this decode always succeeds
+        return str(data, 'ISO-8859-1')
+
+def read_text_file(file_path):
+        """
+        Read a text file, decoding it as UTF-8 and falling back to ISO-8859-1.
+        The file is read from disk once; the fallback decodes the data already in memory.
+        Files of MMAP_THRESHOLD bytes or more are memory-mapped and decoded straight from the
+        mapping, so no intermediate bytes copy of a large file is held next to the decoded text.
+
+        :param file_path: Path to the file.
+        :return: The decoded file content.
+        """
+        with open(file_path, 'rb') as file:
+                if os.fstat(file.fileno()).st_size >= MMAP_THRESHOLD:
+                        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                                return _decode_text(data)
+                data = file.read()
+        return _decode_text(data)
+
 def fetch_data_from_directories(student_code_dir, autograder_output_file, readme_file):
         """
         Fetch data from the specified directories and files with proper encoding handling.
@@ -33,116 +138,238 @@ def fetch_data_from_directories(student_code_dir, autograder_output_file, readme
         :param autograder_output_file: Path to the autograder output file.
         :param readme_file: Path to the professor instructions (README).
         :return: A tuple containing:
-                         - A string with all student code content.
+                         - A dict mapping each student code filename to its content.
                          - A string with the autograder output.
                          - A string with the professor instructions.
         """
-        student_code_data = ""
-        # Iterate over each file in the student code directory
-        for filename in os.listdir(student_code_dir):
-                file_path = os.path.join(student_code_dir, filename)
-                if os.path.isfile(file_path):
-                        # Try reading the file using UTF-8 encoding first
-                        try:
-                                with open(file_path, 'r', encoding='utf-8') as file:
-                                        student_code_data += f"File: {filename}\n{file.read()}\n\n"
-                        except UnicodeDecodeError:
-                                # If UTF-8 fails, try ISO-8859-1 encoding
-                                try:
-                                        with open(file_path, 'r', encoding='ISO-8859-1') as file:
-                                                student_code_data += f"File: {filename}\n{file.read()}\n\n"
-                                except UnicodeDecodeError:
-                                        # If both encodings fail, print a warning and skip the file
-                                        print(f"Warning: Could not read file {filename} due to encoding issues.")
-
-        # Read the autograder output with encoding handling
-        try:
-                with open(autograder_output_file, 'r', encoding='utf-8') as file:
-                        autograder_output = file.read()
-        except UnicodeDecodeError:
-                with open(autograder_output_file, 'r', encoding='ISO-8859-1') as file:
-                        autograder_output = file.read()
+        # List the student code files, skipping binary ones; scandir reports the file type
+        # from the directory listing itself, saving a stat() call per entry
+        with os.scandir(student_code_dir) as entries:
+                code_files = [
+                        entry for entry in entries
+                        if entry.is_file() and os.path.splitext(entry.name)[1].lower() not in SKIPPED_EXTENSIONS
+                ]
 
-        # Read the professor instructions with encoding handling
-        try:
-                with open(readme_file, 'r', encoding='utf-8') as file:
-                        professor_instructions = file.read()
-        except UnicodeDecodeError:
-                with open(readme_file, 'r', encoding='ISO-8859-1') as file:
-                        professor_instructions = file.read()
+        # Read the files on a small thread pool so several reads are in flight at once
+        with ThreadPoolExecutor(max_workers=READ_WORKERS) as executor:
+                contents = executor.map(read_text_file, [entry.path for entry in code_files])
+                student_files = {entry.name: content for entry, content in zip(code_files, contents)}
+
+        # Read the autograder output and the professor instructions
+        autograder_output = read_text_file(autograder_output_file)
+        professor_instructions = read_text_file(readme_file)
+
+        return student_files, autograder_output, professor_instructions
+
+def format_student_code(student_files):
+        """
+        Combine the student code files into the single block of text used in the Ollama prompt.
+
+        To keep the prompt short, runs of blank lines are collapsed, files longer than
+        MAX_FILE_CHARS keep only their beginning and end, and a file identical to one already
+        included is listed by name only.
+
+        :param student_files: Dict mapping each student code filename to its content.
+        :return: A string with every file prefixed by a "File: <name>" header.
+        """
+        # Collect the pieces and join once at the end so the prompt grows linearly
+        parts = []
+        seen_files = {}
+        for filename, content in student_files.items():
+                parts.append("File: ")
+                parts.append(filename)
+                parts.append("\n")
+                if content in seen_files:
+                        parts.append(f"(identical to {seen_files[content]})")
+                else:
+                        seen_files[content] = filename
+                        text = _BLANK_LINES.sub("\n\n", content)
+                        if len(text) > MAX_FILE_CHARS:
+                                half = MAX_FILE_CHARS // 2
+                                text = text[:half] + "\n...[truncated]...\n" + text[-half:]
+                        parts.append(text)
+                parts.append("\n\n")
+        return "".join(parts)
+
+def _ollama_request_body(prompt_sections):
+        """
+        Yield the JSON body of an Ollama generate request piece by piece.
+
+        Each prompt section is JSON-escaped on its own, so the full prompt never has to be
+        assembled into one string before it is sent.
+        """
+        yield f'{{"model": {json.dumps(OLLAMA_MODEL)}, "stream": true, "prompt": "'.encode('utf-8')
+        for section in prompt_sections:
+                yield json.dumps(section)[1:-1].encode('utf-8')
+        yield b'"}'
+
+
+def _get_ollama_connection():
+        """
+        Return this thread's HTTP connection to the Ollama server, creating it on first use.
+        The connection is kept alive between requests and reopened automatically if it was closed.
+        """
+        connection = getattr(_ollama_local, "connection", None)
+        if connection is None:
+                connection = http.client.HTTPConnection(OLLAMA_HOST, OLLAMA_PORT, timeout=OLLAMA_TIMEOUT)
+                _ollama_local.connection = connection
+        return connection
+
+
+def _post_to_ollama(prompt_sections):
+        """
+        Post a generate request for the prompt sections and return the HTTP response once its
+        headers have arrived. The response body still has to be read by the caller.
+        """
+        for attempt in range(2):
+                connection = _get_ollama_connection()
+                try:
+                        # Call the 'ux1' model; the body is sent with chunked transfer encoding
+                        connection.request(
+                                'POST', '/api/generate',
+                                body=_ollama_request_body(prompt_sections),
+                                headers={'Content-Type': 'application/json'}
+                        )
+                        return connection.getresponse()
+                except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                        # The server dropped the idle keep-alive connection; reconnect once
+                        connection.close()
+                        if attempt:
+                                raise
+                except Exception:
+                        # Reset the connection so the next request starts from a clean state
+                        connection.close()
+                        raise
 
-        return student_code_data, autograder_output, professor_instructions
 
-def send_data_to_ollama(student_code_data, autograder_output, professor_instructions):
+def send_and_stream_to_file(student_id, student_code_data, autograder_output, professor_instructions, feedback_file_path):
         """
-        Send combined data (student code, autograder output, professor instructions) to the Ollama model.
+        Send combined data (student code, autograder output, professor instructions) to the Ollama model
+        and write the generated feedback to a Markdown file as it is produced.
         
-        The Ollama model ux1 is a subprocess call that takes a prompt as input and returns a response.
+        The prompt is posted to the generate endpoint of the local Ollama server over a persistent
+        connection, so the ux1 model stays loaded between runs instead of being started per call.
+        The prompt is streamed to the server section by section rather than built as one string,
+        and each piece of the reply is written to a temporary file next to the feedback file as soon
+        as it arrives. The temporary file replaces the feedback file only once the whole reply has
+        arrived, so a failed run never overwrites earlier feedback.
         If an error occurs, it returns a dictionary containing the error message.
-        Otherwise, it returns a dictionary with the response.
+        Otherwise, it returns a dictionary with the full response.
+
+        :param student_id: The ID of the student (repository name).
+        :param feedback_file_path: Path of the Markdown file to write the feedback to.
         """
-        prompt = (
-                f"DO NOT CORRECT THE CODE!!! ONLY PROVIDE Question-based guided FEEDBACK BASED ON THIS:\n"
-                f"**Student Code:**\n{student_code_data}\n\n"
-                f"**Autograder Output:**\n{autograder_output}\n\n"
-                f"**Professor Instructions:**\n{professor_instructions}\n\n"
+        prompt_sections = (
+                "DO NOT CORRECT THE CODE!!! ONLY PROVIDE Question-based guided FEEDBACK BASED ON THIS:\n",
+                "**Student Code:**\n", student_code_data, "\n\n",
+                "**Autograder Output:**\n", autograder_output, "\n\n",
+                "**Professor Instructions:**\n", professor_instructions, "\n\n",
         )
 
+        temp_file_path = feedback_file_path + '.tmp'
         try:
-                # Call the 'ollama ux1' model with the prompt as input
-                result = subprocess.run(
-                        ['ollama', 'run', 'ux1'],
-                        input=prompt,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                        text=True
-                )
-                # Check the return code to identify any subprocess errors
-                if result.returncode != 0:
-                        print(f"Error running Ollama: {result.stderr}")
-                        return {"error": result.stderr}
-                # If successful, return the stdout response
-                return {"response": result.stdout}
+                response = _post_to_ollama(prompt_sections)
+                # Check the status code to identify any server errors
+                if response.status != 200:
+                        error = json.loads(response.read()).get("error", f"HTTP {response.status}")
+                        print(f"Error running Ollama: {error}")
+                        return {"error": error}
+
+                # Keep the pieces as well, the full feedback text is stored in the database afterwards
+                feedback_parts = []
+                with open(temp_file_path, 'w', encoding='utf-8') as file:
+                        file.write(f"# Feedback for {student_id}\n\n")
+                        # Each line of the streamed reply is a JSON object carrying the next piece of text
+                        for line in response:
+                                chunk = json.loads(line)
+                                if "error" in chunk:
+                                        raise RuntimeError(chunk["error"])
+                                file.write(chunk.get("response", ""))
+                                feedback_parts.append(chunk.get("response", ""))
+                # Swap the complete feedback in; this also gives every run a new file, so hard links
+                # made to an earlier feedback file keep that run's content
+                os.replace(temp_file_path, feedback_file_path)
+                print(f"Feedback saved to {feedback_file_path}")
+                return {"response": "".join(feedback_parts)}
         except Exception as e:
-                # Catch any unexpected exceptions
+                # Catch any unexpected exceptions; the reply may not have been read to the end,
+                # so the connection cannot be reused
+                _get_ollama_connection().close()
+                # Drop the partial feedback, leaving any earlier feedback file untouched
+                try:
+                        os.unlink(temp_file_path)
+                except FileNotFoundError:
+                        pass
                 print(f"Failed to run Ollama model: {e}")
                 return {"error": str(e)}
 
 
-def write_feedback_to_file(student_id, assignment_id, feedback):
+def link_or_copy(src, dest):
         """
-        Write the generated feedback to a Markdown file.
-        
-        :param student_id: The ID of the student (repository name).
-        :param assignment_id: The assignment ID (hard-coded in this script).
-        :param feedback: The feedback text generated by the Ollama model.
-        :return: The path to the feedback file if successful, otherwise None.
+        Make dest a hard link to src, falling back to a copy when linking is not possible (for
+        example when the two paths are on different filesystems).
         """
-        cwd = os.getcwd()
-        feedback_file_path = os.path.join(cwd, 'feedback.md')
+        # Nothing to do when the feedback was written straight into the logs directory
+        if os.path.realpath(src) == os.path.realpath(dest):
+                return
         try:
-                # Write feedback to the specified markdown file
-                with open(feedback_file_path, 'w', encoding='utf-8') as file:
-                        file.write(f"# Feedback for {student_id}\n\n")
-                        file.write(feedback)
-                print(f"Feedback saved to {feedback_file_path}")
-                home = os.getenv('HOME') or cwd
-                logs_dir = os.path.join(home, 'logs')
-                if os.path.isdir(logs_dir):
-                        dest = os.path.join(logs_dir, 'feedback.md')
-                        try:
-                                shutil.copy(feedback_file_path, dest)  # ADDED: copy feedback to logs
-                                print(f"Copied feedback to logs directory: {dest}")  # ADDED: confirm copy
-                                return dest  # ADDED: return logs path
-                        except Exception as copy_err:
-                                print(f"Failed to copy feedback to logs: {copy_err}")
-                return feedback_file_path
-        except Exception as e:
-                # If writing to file fails, print error and return None
-                print(f"Failed to write to Feedback.md: {e}")
-                return None
+                os.unlink(dest)
+        except FileNotFoundError:
+                pass
+        try:
+                os.link(src, dest)
+        except OSError:
+                shutil.copy(src, dest)
 
-def insert_into_database(student_id, assignment_id, test_id, feedback, feedback_file_path, student_code_dir, autograder_output_file):
+def copy_feedback_to_logs(feedback_file_path):
+        """
+        Put a copy of the feedback file into the ~/logs directory, if it exists.
+
+        :param feedback_file_path: The path to the feedback file.
+        :return: The path to the copy in ~/logs if one was made, otherwise feedback_file_path.
+        """
+        if os.path.isdir(LOGS_DIR):
+                dest = os.path.join(LOGS_DIR, 'feedback.md')
+                try:
+                        link_or_copy(feedback_file_path, dest)  # ADDED: copy feedback to logs
+                        print(f"Copied feedback to logs directory: {dest}")  # ADDED: confirm copy
+                        return dest  # ADDED: return logs path
+                except Exception as copy_err:
+                        print(f"Failed to copy feedback to logs: {copy_err}")
+        return feedback_file_path
+
+def get_db_connection():
+        """
+        Return the shared connection to the SQLite database, opening it on first use.
+
+        The connection is tuned once when it is opened and then reused for every insert made by
+        this process, so grading several students does not reconnect or re-prepare statements.
+        """
+        global _db_connection
+        if _db_connection is None:
+                # isolation_level=None leaves transaction control to insert_into_database, and the
+                # timeout sets how long a write waits for another process's lock
+                conn = sqlite3.connect(DB_PATH, isolation_level=None, timeout=DB_BUSY_TIMEOUT)
+                # Tune the connection for this append-mostly workload: WAL avoids the rollback
+                # journal double-write and NORMAL sync skips the extra fsync on each commit
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                conn.execute("PRAGMA cache_size=-20000")
+                conn.execute("PRAGMA temp_store=MEMORY")
+                conn.execute("PRAGMA cache_spill=OFF")
+                _db_connection = conn
+        return _db_connection
+
+def close_db_connection():
+        """
+        Close the shared database connection if it was opened.
+        """
+        global _db_connection
+        if _db_connection is not None:
+                _db_connection.close()
+                _db_connection = None
+
+def insert_into_database(conn, student_id, assignment_id, test_id, feedback, feedback_file_path, student_files, autograder_output):
         """
         Insert all retrieved and generated data into the SQLite database.
         
@@ -151,104 +378,199 @@ def insert_into_database(student_id, assignment_id, test_id, feedback, feedback_
         - Autograder output into the autograder_outputs table
         - Feedback into the feedback table
         
+        :param conn: The database connection, see get_db_connection.
         :param student_id: The student's repository name.
         :param assignment_id: The assignment ID.
         :param test_id: The test ID.
         :param feedback: The feedback text generated.
         :param feedback_file_path: The path to the feedback file.
-        :param student_code_dir: Directory containing the student code files.
-        :param autograder_output_file: The path to the autograder output file.
+        :param student_files: Dict mapping each student code filename to its content, as already
+                              read by fetch_data_from_directories.
+        :param autograder_output: The autograder output text.
         """
-        db_path = os.path.join(os.getenv("HOME"), "agllmdatabase.db")
-        conn = None
+        # Timestamp every row of this run once, in SQLite's datetime() format
+        timestamp = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        # Pack the code for the single-statement insert unless it would truncate a file
+        code_payload = None
+        if not any('\x00' in code_content for code_content in student_files.values()):
+                code_payload = json.dumps(list(student_files.values()))
 
-        try:
-                # Connect to the SQLite database
-                conn = sqlite3.connect(db_path)
-                cursor = conn.cursor()
-
-                # Insert each student code file into the submissions table
-                for filename in os.listdir(student_code_dir):
-                        file_path = os.path.join(student_code_dir, filename)
-                        if os.path.isfile(file_path):
-                                # Read the code file content
-                                with open(file_path, 'r', encoding='utf-8') as file:
-                                        code_content = file.read()
-                                cursor.execute(
-                                        '''
-                                        INSERT INTO submissions (student_repo, assignment_id, code, submitted_at)
-                                        VALUES (?, ?, ?, datetime('now', 'utc'))
-                                        ''',
-                                        (student_id, assignment_id, code_content)
-                                )
-
-                # Get the submission ID of the last inserted row to link to feedback and autograder outputs
-                submission_id = cursor.lastrowid
-
-                # Insert the autograder output into autograder_outputs table
-                with open(autograder_output_file, 'r', encoding='utf-8') as file:
-                        autograder_output = file.read()
-                cursor.execute(
-                        '''
-                        INSERT INTO autograder_outputs (submission_id, output, generated_at)
-                        VALUES (?, ?, datetime('now', 'utc'))
-                        ''',
-                        (submission_id, autograder_output)
+        for attempt in range(DB_WRITE_ATTEMPTS):
+                try:
+                        # Group every insert below into a single transaction so the run commits once.
+                        # IMMEDIATE takes the write lock up front instead of upgrading a read lock
+                        # later, which is where parallel graders would run into SQLITE_BUSY
+                        conn.execute("BEGIN IMMEDIATE")
+                        cursor = conn.cursor()
+
+                        # Insert every student code file into the submissions table, collecting the IDs
+                        # that SQLite assigned to the rows from the RETURNING clause
+                        if code_payload is not None:
+                                submission_ids = [row[0] for row in cursor.execute(
+                                        SQL_INSERT_SUBMISSIONS, (student_id, assignment_id, timestamp, code_payload)
+                                )]
+                        else:
+                                submission_ids = [
+                                        cursor.execute(SQL_INSERT_SUBMISSION, (student_id, assignment_id, code_content, timestamp)).fetchone()[0]
+                                        for code_content in student_files.values()
+                                ]
+
+                        # Link feedback and autograder outputs to the last inserted submission
+                        # (RETURNING does not guarantee row order, but IDs grow with insertion order)
+                        submission_id = max(submission_ids) if submission_ids else None
+
+                        # Insert the autograder output into autograder_outputs table
+                        cursor.execute(SQL_INSERT_AUTOGRADER_OUTPUT, (submission_id, autograder_output, timestamp))
+
+                        # Insert the feedback into the feedback table
+                        cursor.execute(SQL_INSERT_FEEDBACK, (submission_id, feedback, timestamp))
+
+                        # Commit all changes to the database
+                        conn.execute("COMMIT")
+                        print("Data successfully inserted into the database.")
+                        return
+
+                except sqlite3.Error as e:
+                        # Discard the partial transaction
+                        if conn.in_transaction:
+                                conn.execute("ROLLBACK")
+                        # If another grader still held the lock after the busy timeout, back off and retry
+                        if isinstance(e, sqlite3.OperationalError) and "locked" in str(e) and attempt + 1 < DB_WRITE_ATTEMPTS:
+                                time.sleep(DB_RETRY_DELAY * 2 ** attempt)
+                                continue
+                        # Catch and print any other SQLite errors
+                        print(f"SQLite error: {e}")
+                        return
+
+def handle_model_response(student_id, assignment_id, test_id, model_response, feedback_file_path, student_files, autograder_output):
+        """
+        Record a run in the database once the Ollama model has written its feedback.
+
+        :param model_response: The dictionary returned by send_and_stream_to_file.
+        :param feedback_file_path: The path to the feedback file.
+        """
+        # If the feedback was generated and written without error, insert data into the database
+        if "error" not in model_response:
+                feedback = model_response.get("response", "No feedback generated.")
+                try:
+                        conn = get_db_connection()
+                except sqlite3.Error as e:
+                        print(f"SQLite error: {e}")
+                        return
+                insert_into_database(conn, student_id, assignment_id, test_id, feedback, feedback_file_path, student_files, autograder_output)
+        else:
+                # If there was an error in generating feedback, print the error message
+                print(f"Error in generating feedback for {student_id}:", model_response["error"])
+
+async def grade_one(student_id, assignment_id, test_id, semaphore, db_executor):
+        """
+        Grade a single student as part of a batch.
+
+        The student's files are read from ~/logs/<student_id>/, which mirrors the single-student
+        layout: a studentcode directory and an autograder_output.txt file. The feedback is written
+        to ~/logs/<student_id>/feedback.md. Reading the files, building the prompt and the model call
+        run on worker threads inside the semaphore, which bounds how many students are loaded and
+        generated at once. The database write runs on db_executor, a single thread that owns the
+        shared connection, so waiting for a locked database never blocks the other students.
+        """
+        student_logs_dir = os.path.join(LOGS_DIR, student_id)
+        feedback_file_path = os.path.join(student_logs_dir, 'feedback.md')
+
+        async with semaphore:
+                # Load the student only once a slot is free, so at most one prompt per slot exists
+                student_files, autograder_output, professor_instructions = await asyncio.to_thread(
+                        fetch_data_from_directories,
+                        os.path.join(student_logs_dir, 'studentcode'),
+                        os.path.join(student_logs_dir, 'autograder_output.txt'),
+                        README_FILE
                 )
+                student_code_data = await asyncio.to_thread(format_student_code, student_files)
 
-                # Insert the feedback into the feedback table
-                cursor.execute(
-                        '''
-                        INSERT INTO feedback (submission_id, feedback_text, generated_at)
-                        VALUES (?, ?, datetime('now', 'utc'))
-                        ''',
-                        (submission_id, feedback)
+                # The whole reply is streamed to disk on the worker thread that owns the connection
+                model_response = await asyncio.to_thread(
+                        send_and_stream_to_file, student_id, student_code_data, autograder_output,
+                        professor_instructions, feedback_file_path
                 )
 
-                # Commit all changes to the database
-                conn.commit()
-                print("Data successfully inserted into the database.")
+        await asyncio.get_running_loop().run_in_executor(
+                db_executor, handle_model_response, student_id, assignment_id, test_id, model_response,
+                feedback_file_path, student_files, autograder_output
+        )
 
-        except sqlite3.Error as e:
-                # Catch and print any SQLite errors
-                print(f"SQLite error: {e}")
+def get_batch_concurrency():
+        """
+        Return how many students a batch grades at once, from the AG_BATCH_CONCURRENCY environment
+        variable. A missing or invalid value falls back to DEFAULT_BATCH_CONCURRENCY, and the result
+        is at least 1.
+        """
+        try:
+                concurrency = int(os.getenv("AG_BATCH_CONCURRENCY", DEFAULT_BATCH_CONCURRENCY))
+        except ValueError:
+                print(f"Warning: Invalid AG_BATCH_CONCURRENCY, using {DEFAULT_BATCH_CONCURRENCY}.")
+                concurrency = DEFAULT_BATCH_CONCURRENCY
+        return max(1, concurrency)
 
-        finally:
-                # Close the database connection
-                if conn:
-                        conn.close()
-def main():
-        # Define the paths for directories and files
-        student_code_dir = os.path.expanduser('~/logs/studentcode')
-        autograder_output_file = os.path.expanduser('~/logs/autograder_output.txt')
-        readme_file = os.path.expanduser('~/logs/README.md')
+async def grade_batch(student_ids, assignment_id, test_id):
+        """
+        Grade several students concurrently, overlapping their Ollama generations.
 
-        # Extract the student ID (based on repository name) from command-line arguments
-        student_id = extract_student_id()
+        :param student_ids: The students' repository names.
+        """
+        semaphore = asyncio.Semaphore(get_batch_concurrency())
+        # All database work happens on this one thread, which opens and closes the shared connection
+        with ThreadPoolExecutor(max_workers=1) as db_executor:
+                try:
+                        results = await asyncio.gather(
+                                *(grade_one(student_id, assignment_id, test_id, semaphore, db_executor) for student_id in student_ids),
+                                return_exceptions=True
+                        )
+                finally:
+                        # Close the connection on its own thread even if the batch was interrupted;
+                        # waiting synchronously keeps this working while the task is being cancelled
+                        db_executor.submit(close_db_connection).result()
+        # A failure for one student should not stop the others from being graded
+        for student_id, result in zip(student_ids, results):
+                if isinstance(result, Exception):
+                        print(f"Failed to grade {student_id}: {result}")
 
+def main():
         # Set assignment_id and test_id (hard-coded values for this example)
         assignment_id = 101
         test_id = 1001
 
+        # "--batch" followed by repository names grades those students concurrently, each from
+        # their own ~/logs/<student_id>/ directory, even when only one name is given
+        if len(sys.argv) > 1 and sys.argv[1] == '--batch':
+                student_ids = sys.argv[2:]
+                if not student_ids:
+                        print("Error: No repository names provided for the batch.")
+                        sys.exit(1)
+                asyncio.run(grade_batch(student_ids, assignment_id, test_id))
+                return
+
+        # Extract the student ID (based on repository name) from command-line arguments
+        student_id = extract_student_id()
+
         # Fetch all the necessary data: student code, autograder output, and professor instructions
-        student_code_data, autograder_output, professor_instructions = fetch_data_from_directories(
-                student_code_dir, autograder_output_file, readme_file
+        student_files, autograder_output, professor_instructions = fetch_data_from_directories(
+                STUDENT_CODE_DIR, AUTOGRADER_OUTPUT_FILE, README_FILE
         )
+        student_code_data = format_student_code(student_files)
 
-        # Send the combined data to the Ollama model for feedback generation
-        model_response = send_data_to_ollama(student_code_data, autograder_output, professor_instructions)
-
-        # If the model responded without error, proceed with writing feedback and database insertion
+        # Send the combined data to the Ollama model, writing its feedback to feedback.md as it is generated
+        feedback_file_path = os.path.join(os.getcwd(), 'feedback.md')
+        model_response = send_and_stream_to_file(
+                student_id, student_code_data, autograder_output, professor_instructions, feedback_file_path
+        )
         if "error" not in model_response:
-                feedback = model_response.get("response", "No feedback generated.")
-                feedback_file_path = write_feedback_to_file(student_id, assignment_id, feedback)
-                # If feedback was successfully written to file, insert data into the database
-                if feedback_file_path:
-                        insert_into_database(student_id, assignment_id, test_id, feedback, feedback_file_path, student_code_dir, autograder_output_file)
-        else:
-                # If there was an error in generating feedback, print the error message
-                print("Error in generating feedback:", model_response["error"])
+                feedback_file_path = copy_feedback_to_logs(feedback_file_path)
+
+        # Record the run in the database
+        handle_model_response(student_id, assignment_id, test_id, model_response, feedback_file_path, student_files, autograder_output)
 
 
 if __name__ == "__main__":
-        main()
+        try:
+                main()
+        finally:
+                close_db_connection()